@@ -1,7 +1,8 @@
 from django.contrib import admin
 from django.utils import timezone
 
-from .models import Event, Registration, Notification, Feedback
+from .models import Event, Registration, Notification, Feedback, WaitlistEntry, CalendarFeed
+from .waitlist import promote_from_waitlist, cancel_waitlist
 
 
 def _notify_participants(event: Event, title: str, body: str):
@@ -27,7 +28,7 @@ class EventAdmin(admin.ModelAdmin):
 
             event.is_cancelled = True
             event.cancelled_at = now
-            event.save(update_fields=["is_cancelled", "cancelled_at"])
+            event.save(update_fields=["is_cancelled", "cancelled_at", "updated_at"])
 
             when_str = f"{event.date} {event.time or ''}".strip()
             _notify_participants(
@@ -35,6 +36,11 @@ class EventAdmin(admin.ModelAdmin):
                 "Мероприятие отменено",
                 f"Мероприятие «{event.title}» ({when_str}) отменено."
             )
+            cancel_waitlist(
+                event,
+                "Мероприятие отменено",
+                f"Мероприятие «{event.title}» ({when_str}) отменено. Лист ожидания закрыт."
+            )
             count += 1
 
         self.message_user(request, f"Отменено мероприятий: {count}")
@@ -63,6 +69,11 @@ class EventAdmin(admin.ModelAdmin):
                     "Мероприятие отменено",
                     f"Мероприятие «{obj.title}» ({when_str}) отменено."
                 )
+                cancel_waitlist(
+                    obj,
+                    "Мероприятие отменено",
+                    f"Мероприятие «{obj.title}» ({when_str}) отменено. Лист ожидания закрыт."
+                )
                 return
 
             # 2) изменение даты/времени/места/названия
@@ -74,6 +85,10 @@ class EventAdmin(admin.ModelAdmin):
             if old.title != obj.title:
                 changed.append("название")
 
+            # 3) свободные места (увеличили вместимость или не прошло прошлое продвижение) — из очереди
+            if not obj.is_cancelled:
+                promote_from_waitlist(obj.pk)
+
             if changed and (not obj.is_cancelled):
                 old_when = f"{old.date} {old.time or ''}".strip()
                 new_when = f"{obj.date} {obj.time or ''}".strip()
@@ -92,6 +107,27 @@ class RegistrationAdmin(admin.ModelAdmin):
     search_fields = ("user__username", "event__title")
 
 
+@admin.register(WaitlistEntry)
+class WaitlistEntryAdmin(admin.ModelAdmin):
+    list_display = ("user", "event", "created_at")
+    list_filter = ("event",)
+    search_fields = ("user__username", "event__title")
+
+
+@admin.register(CalendarFeed)
+class CalendarFeedAdmin(admin.ModelAdmin):
+    list_display = ("user", "rotated_at")
+    search_fields = ("user__username",)
+    actions = ["rotate_keys"]
+
+    def rotate_keys(self, request, queryset):
+        for feed in queryset:
+            feed.rotate()
+        self.message_user(request, f"Ссылок отозвано: {queryset.count()}")
+
+    rotate_keys.short_description = "Выдать новые ссылки (старые перестанут работать)"
+
+
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
     list_display = ("user", "title", "is_read", "created_at")
@@ -0,0 +1,149 @@
+from datetime import datetime, timezone as dt_timezone
+from hashlib import sha1
+
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .models import CalendarFeed, Event, Registration
+
+FEED_CACHE_TIMEOUT = 60 * 60 * 24
+PRODID = "-//KINI x Yessenov//Events//RU"
+
+
+def feed_token_for(user):
+    feed, _ = CalendarFeed.objects.get_or_create(user=user)
+    return feed.key
+
+
+def user_id_from_token(token):
+    return CalendarFeed.objects.filter(key=token).values_list("user_id", flat=True).first()
+
+
+def feed_state(user_id):
+    """
+    Один агрегирующий запрос: отпечаток регистраций пользователя и их событий.
+    Меняется при записи/удалении регистрации и при любом сохранении события.
+    Last-Modified не отдаём: удаление регистрации не сдвигает ни одну метку,
+    поэтому валидатор — только ETag.
+    """
+    agg = Registration.objects.filter(user_id=user_id).aggregate(
+        n=Count("id"),
+        reg_max=Max("created_at"),
+        event_max=Max("event__updated_at"),
+    )
+    raw = f"{user_id}:{agg['n']}:{agg['reg_max']}:{agg['event_max']}"
+    return sha1(raw.encode()).hexdigest()
+
+
+def _escape(text):
+    return (
+        (text or "")
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def _fold(line):
+    # RFC 5545: строки не длиннее 75 октетов, перенос — CRLF + пробел
+    raw = line.encode("utf-8")
+    if len(raw) <= 75:
+        return line
+
+    parts = []
+    chunk = b""
+    limit = 75
+    for ch in line:
+        b = ch.encode("utf-8")
+        if len(chunk) + len(b) > limit:
+            parts.append(chunk.decode("utf-8"))
+            chunk = b""
+            limit = 74  # первая позиция продолжения занята пробелом
+        chunk += b
+    parts.append(chunk.decode("utf-8"))
+    return "\r\n ".join(parts)
+
+
+def _utc_stamp(dt):
+    return dt.astimezone(dt_timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def _vevent(event: Event):
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:event-{event.pk}@kini-events",
+        f"DTSTAMP:{_utc_stamp(event.updated_at)}",
+    ]
+
+    if event.time:
+        dt = timezone.make_aware(datetime.combine(event.date, event.time), timezone.get_current_timezone())
+        lines.append(f"DTSTART:{_utc_stamp(dt)}")
+    else:
+        lines.append(f"DTSTART;VALUE=DATE:{event.date.strftime('%Y%m%d')}")
+
+    lines.append(f"SUMMARY:{_escape(event.title)}")
+    if event.description:
+        lines.append(f"DESCRIPTION:{_escape(event.description)}")
+    if event.place:
+        lines.append(f"LOCATION:{_escape(event.place)}")
+
+    if event.is_cancelled:
+        lines.append("STATUS:CANCELLED")
+    else:
+        lines.append("STATUS:CONFIRMED")
+
+    lines.append("END:VEVENT")
+    return "\r\n".join(_fold(line) for line in lines)
+
+
+def _vevent_key(event: Event):
+    return f"ics:vevent:{event.pk}:{event.updated_at.timestamp()}"
+
+
+def build_feed(user_id):
+    """
+    Собирает VCALENDAR инкрементально: блок VEVENT кешируется по (id, updated_at),
+    поэтому при изменении одного события перерисовывается только он.
+    """
+    events = list(
+        Event.objects
+        .filter(registrations__user_id=user_id)
+        .order_by("date", "time")
+    )
+
+    keys = {e.pk: _vevent_key(e) for e in events}
+    cached = cache.get_many(keys.values())
+
+    missing = {}
+    blocks = []
+    for e in events:
+        block = cached.get(keys[e.pk])
+        if block is None:
+            block = _vevent(e)
+            missing[keys[e.pk]] = block
+        blocks.append(block)
+
+    if missing:
+        cache.set_many(missing, FEED_CACHE_TIMEOUT)
+
+    head = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{PRODID}",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        "X-WR-CALNAME:KINI — мои мероприятия",
+    ]
+    return "\r\n".join(head + blocks + ["END:VCALENDAR"]) + "\r\n"
+
+
+def cached_feed(user_id, etag):
+    key = f"ics:feed:{user_id}:{etag}"
+    body = cache.get(key)
+    if body is None:
+        body = build_feed(user_id)
+        cache.set(key, body, FEED_CACHE_TIMEOUT)
+    return body
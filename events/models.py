@@ -1,3 +1,5 @@
+import secrets
+
 from django.conf import settings
 from django.db import models
 
@@ -20,6 +22,9 @@ class Event(models.Model):
     is_cancelled = models.BooleanField(default=False)
     cancelled_at = models.DateTimeField(null=True, blank=True)
 
+    # любое изменение события (в т.ч. отмена) сдвигает метку — по ней инвалидируется .ics-лента
+    updated_at = models.DateTimeField(auto_now=True)
+
     class Meta:
         ordering = ["date", "time"]
 
@@ -48,6 +53,39 @@ class Registration(models.Model):
         return f"{self.user} → {self.event.title}"
 
 
+class WaitlistEntry(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="waitlist_entries")
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name="waitlist")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("user", "event")
+        ordering = ["created_at", "id"]
+        # голова очереди берётся по индексу — без сканирования всего листа
+        indexes = [models.Index(fields=["event", "created_at", "id"])]
+
+    def __str__(self):
+        return f"Waitlist({self.user} → {self.event.title})"
+
+
+def new_feed_key():
+    return secrets.token_urlsafe(24)
+
+
+class CalendarFeed(models.Model):
+    # секрет в ссылке подписки .ics; смена ключа отзывает утёкшую ссылку
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="calendar_feed")
+    key = models.CharField(max_length=64, unique=True, default=new_feed_key)
+    rotated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"CalendarFeed({self.user})"
+
+    def rotate(self):
+        self.key = new_feed_key()
+        self.save(update_fields=["key", "rotated_at"])
+
+
 class Notification(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="notifications")
     title = models.CharField(max_length=200)
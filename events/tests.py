@@ -1,3 +1,405 @@
-from django.test import TestCase
+from contextlib import ExitStack
+from datetime import date, time, timedelta
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from django.contrib.admin import AdminSite
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.conf import settings
+from django.db import OperationalError, connections, router
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from eventsystem.db_router import PIN_COOKIE, PrimaryPinMiddleware, use_replica
+
+from .admin import EventAdmin
+from .ics import feed_token_for
+from .models import Event, Registration, Notification, WaitlistEntry
+from .waitlist import promote_from_waitlist
+
+
+def _read_alias():
+    return settings.DATABASE_REPLICAS[0] if settings.DATABASE_REPLICAS else "default"
+
+
+def _queries_by_alias(func):
+    # запросы по каждому соединению: при настроенной реплике чтения уходят на неё
+    with ExitStack() as stack:
+        ctxs = {a: stack.enter_context(CaptureQueriesContext(connections[a])) for a in settings.DATABASES}
+        result = func()
+    return result, {a: [q["sql"] for q in c.captured_queries] for a, c in ctxs.items()}
+
+
+class IcsFeedTests(TransactionTestCase):
+    # @use_replica-view читают с реплики, если она настроена (KINI_REPLICA_DB):
+    # зеркало — отдельное соединение и видит только закоммиченные данные
+    databases = "__all__"
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("a", "a@a.kz", "p")
+        self.e1 = Event.objects.create(title="Лекция", date=date(2030, 1, 1), time=time(10, 0))
+        self.e2 = Event.objects.create(title="Семинар", date=date(2030, 1, 2))
+        Registration.objects.create(user=self.user, event=self.e1)
+        Registration.objects.create(user=self.user, event=self.e2)
+        self.url = f"/calendar/{feed_token_for(self.user)}.ics"
+
+    def test_feed_lists_registered_events(self):
+        r = self.client.get(self.url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content.count(b"BEGIN:VEVENT"), 2)
+        self.assertNotIn("Last-Modified", r)
+        self.assertNotIn(b"SEQUENCE", r.content)
+
+    def test_bad_token_is_404(self):
+        self.assertEqual(self.client.get("/calendar/bad.ics").status_code, 404)
+
+    def test_rotation_revokes_old_link(self):
+        self.client.login(username="a", password="p")
+        self.client.post("/calendar/rotate/")
+
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        new_url = f"/calendar/{feed_token_for(self.user)}.ics"
+        self.assertNotEqual(new_url, self.url)
+        self.assertEqual(self.client.get(new_url).status_code, 200)
+
+    def test_etag_revalidation(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.e1.is_cancelled = True
+        self.e1.save()
+        r = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b"STATUS:CANCELLED", r.content)
+
+    def test_deleted_registration_is_not_hidden_by_if_modified_since(self):
+        self.client.get(self.url)
+        Registration.objects.filter(event=self.e2).delete()
+
+        r = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE="Fri, 01 Jan 2100 00:00:00 GMT")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content.count(b"BEGIN:VEVENT"), 1)
+
+
+class DashboardBootstrapTests(TransactionTestCase):
+    # @use_replica-view читают с реплики, если она настроена (KINI_REPLICA_DB):
+    # зеркало — отдельное соединение и видит только закоммиченные данные
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = User.objects.create_user("a", "a@a.kz", "p")
+        other = User.objects.create_user("b", "b@b.kz", "p")
+        self.events = [Event.objects.create(title=f"E{i}", date=date(2030, 1, 1 + i), capacity=1) for i in range(4)]
+        Registration.objects.create(user=self.user, event=self.events[3])
+        Registration.objects.create(user=self.user, event=self.events[1])
+        Registration.objects.create(user=other, event=self.events[2])
+        Notification.objects.create(user=self.user, title="n")
+        self.client.login(username="a", password="p")
+
+    def test_bootstrap_matches_separate_endpoints(self):
+        data = self.client.get("/dashboard-json/").json()
+
+        self.assertEqual(data["events"], self.client.get("/events-json/").json())
+        self.assertEqual(data["my_events"], self.client.get("/my-events-json/").json())
+        self.assertEqual([e["id"] for e in data["my_events"]], [self.events[3].id, self.events[1].id])
+        self.assertEqual(len(data["notifications"]), 1)
+
+        # bootstrap не помечает уведомления прочитанными
+        self.assertTrue(Notification.objects.filter(user=self.user, is_read=False).exists())
+
+    def test_events_json_query_count_does_not_grow_with_events(self):
+        self.client.get("/events-json/")
+        _, queries = _queries_by_alias(lambda: self.client.get("/events-json/"))
+        # сессия, пользователь, каталог
+        self.assertEqual(sum(len(q) for q in queries.values()), 3)
+        # подзапрос «мои события» нужен только bootstrap
+        self.assertEqual(queries[_read_alias()][-1].count("SELECT"), 1)
+
+        more = Event.objects.bulk_create([Event(title=f"M{i}", date=date(2031, 1, 1 + i)) for i in range(20)])
+        Registration.objects.bulk_create([Registration(user=self.user, event=e) for e in more])
+        response, queries = _queries_by_alias(lambda: self.client.get("/events-json/"))
+        self.assertEqual(sum(len(q) for q in queries.values()), 3)
+        self.assertEqual(len(response.json()), 24)
+
+    def test_dashboard_embeds_bootstrap(self):
+        r = self.client.get("/dashboard/")
+        self.assertContains(r, 'id="dashboardBootstrap"')
+
+
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.seen = []
+
+        @use_replica
+        def view(request):
+            self.seen.append(router.db_for_read(Event))
+            return HttpResponse("ok")
+
+        self.view = view
+
+    @override_settings(DATABASE_REPLICAS=["replica"])
+    def test_get_reads_replica(self):
+        self.view(self.factory.get("/"))
+        self.assertEqual(self.seen, ["replica"])
+        # вне view — снова primary
+        self.assertEqual(router.db_for_read(Event), "default")
+
+    @override_settings(DATABASE_REPLICAS=["replica"])
+    def test_writes_and_post_go_to_primary(self):
+        self.view(self.factory.post("/"))
+        self.assertEqual(self.seen, ["default"])
+        self.assertEqual(router.db_for_write(Event), "default")
+
+    @override_settings(DATABASE_REPLICAS=["replica"])
+    def test_pinned_request_reads_primary(self):
+        request = self.factory.get("/")
+        request.COOKIES[PIN_COOKIE] = "1"
+        self.view(request)
+        self.assertEqual(self.seen, ["default"])
+
+    @override_settings(DATABASE_REPLICAS=["replica"], REPLICA_PIN_SECONDS=5)
+    def test_post_sets_pin_cookie(self):
+        middleware = PrimaryPinMiddleware(lambda request: HttpResponse("ok"))
+
+        response = middleware(self.factory.post("/"))
+        self.assertEqual(response.cookies[PIN_COOKIE]["max-age"], 5)
+
+        response = middleware(self.factory.get("/"))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas_reads_primary(self):
+        self.view(self.factory.get("/"))
+        self.assertEqual(self.seen, ["default"])
+
+    def test_migrate_only_on_primary(self):
+        self.assertTrue(router.allow_migrate("default", "events"))
+        self.assertFalse(router.allow_migrate("replica", "events"))
+
+
+@skipUnless("replica" in settings.DATABASES, "нужна реплика: KINI_REPLICA_DB=...")
+class ReplicaConnectionTests(TransactionTestCase):
+    # реплика — TEST MIRROR на default: в тестах второй файл указывает на ту же базу
+    databases = "__all__"
+
+    def setUp(self):
+        User.objects.create_user("a", "a@a.kz", "p")
+        self.event = Event.objects.create(title="E", date=date(2030, 1, 1))
+        self.client.login(username="a", password="p")
+
+    def catalogue_reads(self, queries):
+        return [alias for alias, sqls in queries.items() for sql in sqls if 'FROM "events_event"' in sql]
+
+    def test_json_reads_through_replica_connection(self):
+        response, queries = _queries_by_alias(lambda: self.client.get("/events-json/"))
+
+        self.assertEqual([e["id"] for e in response.json()], [self.event.id])
+        self.assertEqual(self.catalogue_reads(queries), ["replica"])
+
+    def test_reads_after_booking_are_pinned_to_primary(self):
+        self.client.post(f"/events/{self.event.id}/book/")
+        self.assertIn(PIN_COOKIE, self.client.cookies)
+
+        response, queries = _queries_by_alias(lambda: self.client.get("/my-events-json/"))
+        self.assertEqual([e["id"] for e in response.json()], [self.event.id])
+        self.assertNotIn("replica", [a for a, sqls in queries.items() if sqls])
+
+
+class NotificationsJsonTests(TransactionTestCase):
+    # @use_replica-view читают с реплики, если она настроена (KINI_REPLICA_DB):
+    # зеркало — отдельное соединение и видит только закоммиченные данные
+    databases = "__all__"
+
+    def test_marks_only_returned_notifications_read(self):
+        user = User.objects.create_user("a", "a@a.kz", "p")
+        # не попало в выдачу (как уведомление, ещё не доехавшее до реплики)
+        hidden = Notification.objects.create(user=user, title="hidden")
+        Notification.objects.bulk_create([Notification(user=user, title=f"n{i}") for i in range(100)])
+        Notification.objects.filter(pk=hidden.pk).update(created_at="2000-01-01T00:00:00Z")
+        self.client.login(username="a", password="p")
+
+        data = self.client.get("/notifications-json/").json()
+
+        self.assertEqual(len(data), 100)
+        self.assertNotIn(hidden.pk, [n["id"] for n in data])
+        self.assertEqual(Notification.objects.filter(user=user, is_read=True).count(), 100)
+        hidden.refresh_from_db()
+        self.assertFalse(hidden.is_read)
+
+
+class WaitlistTests(TestCase):
+    def setUp(self):
+        self.users = {n: User.objects.create_user(n, f"{n}@a.kz", "p") for n in "xyzvw"}
+        self.event = Event.objects.create(title="E", date=date(2030, 1, 1), capacity=1)
+
+    def book(self, name):
+        self.client.login(username=name, password="p")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/events/{self.event.id}/book/")
+
+    def cancel(self, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            Registration.objects.get(event=self.event, user=self.users[name]).delete()
+
+    def registered(self):
+        return set(self.event.registrations.values_list("user__username", flat=True))
+
+    def queue(self):
+        return list(self.event.waitlist.values_list("user__username", flat=True))
+
+    def assertInvariants(self):
+        self.event.refresh_from_db()
+        self.assertLessEqual(len(self.registered()), self.event.capacity)
+        self.assertFalse(self.registered() & set(self.queue()))
+        if self.queue():
+            self.assertEqual(len(self.registered()), self.event.capacity)
+
+    def test_full_event_queues_in_join_order(self):
+        for n in "xyz":
+            self.book(n)
+        self.assertEqual(self.registered(), {"x"})
+        self.assertEqual(self.queue(), ["y", "z"])
+        self.assertInvariants()
+
+    def test_cancellation_promotes_head_of_queue(self):
+        for n in "xyz":
+            self.book(n)
+        self.cancel("x")
+
+        self.assertEqual(self.registered(), {"y"})
+        self.assertEqual(self.queue(), ["z"])
+        self.assertTrue(Notification.objects.filter(user=self.users["y"], title="Место освободилось").exists())
+        self.assertInvariants()
+
+    def test_direct_booking_cannot_jump_the_queue(self):
+        for n in "xyzv":
+            self.book(n)
+        # вместимость подняли в обход админки — очередь не продвинулась
+        Event.objects.filter(pk=self.event.pk).update(capacity=3)
+
+        self.book("z")
+        self.assertEqual(self.registered(), {"x", "y", "z"})
+        self.assertEqual(self.queue(), ["v"])
+        self.assertInvariants()
+
+        self.cancel("x")
+        self.assertEqual(self.registered(), {"y", "z", "v"})
+        self.assertEqual(self.queue(), [])
+        # z получил место по очереди один раз — без ложного повторного уведомления
+        self.assertEqual(Notification.objects.filter(user=self.users["z"], title="Место освободилось").count(), 1)
+
+    def test_stale_entry_does_not_waste_a_seat(self):
+        for n in "xyz":
+            self.book(n)
+        # устаревшая запись: z уже записан, но остался в очереди
+        Event.objects.filter(pk=self.event.pk).update(capacity=2)
+        Registration.objects.create(user=self.users["z"], event=self.event)
+        Event.objects.filter(pk=self.event.pk).update(capacity=3)
+
+        self.assertEqual(promote_from_waitlist(self.event.pk), [self.users["y"].pk])
+        self.assertEqual(self.registered(), {"x", "y", "z"})
+        self.assertEqual(self.queue(), [])
+
+    def test_capacity_raise_promotes_in_one_batch(self):
+        for n in "xyzvw":
+            self.book(n)
+        Event.objects.filter(pk=self.event.pk).update(capacity=4)
+
+        promoted = promote_from_waitlist(self.event.pk)
+        self.assertEqual(promoted, [self.users[n].pk for n in "yzv"])
+        self.assertEqual(self.queue(), ["w"])
+        self.assertInvariants()
+
+    def test_failed_promotion_recovers_on_next_booking(self):
+        for n in "xyz":
+            self.book(n)
+
+        with patch("events.waitlist.promote_from_waitlist", side_effect=OperationalError("database is locked")), \
+                patch("events.waitlist.time.sleep"), \
+                self.assertLogs("events.waitlist", "WARNING"):
+            self.cancel("x")
+        self.assertEqual(self.registered(), set())
+
+        self.book("v")
+        self.assertEqual(self.registered(), {"y"})
+        self.assertEqual(self.queue(), ["z", "v"])
+        self.assertInvariants()
+
+    def test_admin_save_promotes_after_capacity_raise(self):
+        for n in "xyz":
+            self.book(n)
+
+        admin = EventAdmin(Event, AdminSite())
+        request = RequestFactory().post("/")
+        self.event.refresh_from_db()
+        self.event.capacity = 2
+        admin.save_model(request, self.event, form=None, change=True)
+
+        self.assertEqual(self.registered(), {"x", "y"})
+        self.assertEqual(self.queue(), ["z"])
+        self.assertInvariants()
+
+    def test_event_started_today_does_not_promote(self):
+        started = timezone.localtime() - timedelta(minutes=1)
+        self.event.date, self.event.time = started.date(), started.time()
+        self.event.save()
+        self.book("x")
+        WaitlistEntry.objects.create(user=self.users["y"], event=self.event)
+        Event.objects.filter(pk=self.event.pk).update(capacity=2)
+
+        self.assertEqual(promote_from_waitlist(self.event.pk), [])
+        self.assertEqual(self.queue(), ["y"])
+
+    def test_admin_cancel_notifies_and_clears_waitlist(self):
+        for n in "xyz":
+            self.book(n)
+
+        admin = EventAdmin(Event, AdminSite())
+        with patch.object(admin, "message_user"):
+            admin.cancel_selected_events(RequestFactory().post("/"), Event.objects.filter(pk=self.event.pk))
+
+        self.assertEqual(self.queue(), [])
+        for n in "yz":
+            self.assertTrue(Notification.objects.filter(user=self.users[n], title="Мероприятие отменено").exists())
+
+    def test_cancel_checkbox_clears_waitlist(self):
+        for n in "xy":
+            self.book(n)
+
+        admin = EventAdmin(Event, AdminSite())
+        self.event.refresh_from_db()
+        self.event.is_cancelled = True
+        admin.save_model(RequestFactory().post("/"), self.event, form=None, change=True)
+
+        self.assertEqual(self.queue(), [])
+        self.assertTrue(Notification.objects.filter(user=self.users["y"], title="Мероприятие отменено").exists())
+
+
+class WaitlistConcurrencyTests(TransactionTestCase):
+    # настоящие коммиты: on_commit-продвижение срабатывает в момент коммита, а не в конце теста
+
+    def test_cancellation_right_after_decision_still_sees_new_entry(self):
+        x = User.objects.create_user("x", "x@a.kz", "p")
+        User.objects.create_user("a", "a@a.kz", "p")
+        event = Event.objects.create(title="E", date=date(2030, 1, 1), capacity=1)
+        Registration.objects.create(user=x, event=event)
+
+        is_full = Event.is_full
+
+        def full_then_cancelled(self_event):
+            result = is_full(self_event)
+            # единственную регистрацию отменяют сразу после решения «мест нет»
+            Registration.objects.filter(event=self_event).delete()
+            return result
+
+        self.client.login(username="a", password="p")
+        with patch.object(Event, "is_full", full_then_cancelled):
+            self.client.post(f"/events/{event.id}/book/")
+
+        self.assertEqual(list(event.registrations.values_list("user__username", flat=True)), ["a"])
+        self.assertFalse(event.waitlist.exists())
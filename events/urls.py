@@ -8,9 +8,12 @@ urlpatterns = [
     path("logout/", views.logout_view, name="logout"),
     path("dashboard/", views.dashboard, name="dashboard"),
 
+    path("dashboard-json/", views.dashboard_bootstrap_json, name="dashboard_bootstrap_json"),
     path("events-json/", views.events_json, name="events_json"),
     path("my-events-json/", views.my_events_json, name="my_events_json"),
     path("notifications-json/", views.notifications_json, name="notifications_json"),
+    path("calendar/<str:token>.ics", views.my_events_ics, name="my_events_ics"),
+    path("calendar/rotate/", views.rotate_ics_token, name="rotate_ics_token"),
 
     path("events/<int:event_id>/book/", views.register_for_event, name="register_for_event"),
     path("events/<int:event_id>/feedback/", views.leave_feedback, name="leave_feedback"),
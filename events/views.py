@@ -2,15 +2,21 @@ from datetime import datetime, time as dtime
 
 from django.utils import timezone
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponseForbidden
+from django.http import JsonResponse, HttpResponse, HttpResponseForbidden, Http404
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
-from django.db import IntegrityError
-from django.db.models import Avg
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Count, OuterRef, Subquery
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 
-from .models import Event, Registration, Notification, Feedback
+from eventsystem.db_router import use_replica
+
+from .ics import feed_token_for, user_id_from_token, feed_state, cached_feed
+from .models import Event, Registration, Notification, Feedback, WaitlistEntry, CalendarFeed
+from .waitlist import promote_from_waitlist
 
 
 def home(request):
@@ -118,6 +124,72 @@ def generate_reminders_for_user(user):
     return created_texts
 
 
+def _catalogue_rows():
+    # каталог со счётчиком мест одним запросом (без registered_count() на каждую строку)
+    return (
+        Event.objects
+        .filter(is_cancelled=False)
+        .annotate(taken=Count("registrations"))
+        .order_by("date", "time")
+    )
+
+
+def _event_item(e: Event, now):
+    dt = _event_dt(e)
+    is_past = dt <= now
+    is_full = e.taken >= e.capacity
+
+    start = f"{e.date}T{(e.time or '00:00')}"
+    return {
+        "id": e.id,
+        "title": e.title,
+        "start": start,
+        "description": e.description,
+        "place": e.place,
+        "capacity": e.capacity,
+        "taken": e.taken,
+        "is_past": is_past,
+        "can_register": (not is_past) and (not is_full),
+    }
+
+
+def _my_event_item(e: Event):
+    return {
+        "id": e.id,
+        "title": e.title,
+        "date": str(e.date),
+        "time": str(e.time) if e.time else "",
+        "place": e.place,
+    }
+
+
+def _notification_item(n: Notification):
+    return {
+        "id": n.id,
+        "title": n.title,
+        "body": n.body,
+        "created": n.created_at.strftime("%Y-%m-%d %H:%M"),
+        "is_read": n.is_read,
+    }
+
+
+def _dashboard_bootstrap(user):
+    now = timezone.localtime()
+    # те же строки каталога + отметка о записи пользователя — «мои события» без второго запроса
+    mine = Registration.objects.filter(user=user, event=OuterRef("pk"))
+    rows = list(_catalogue_rows().annotate(my_registered_at=Subquery(mine.values("created_at")[:1])))
+
+    # «мои события» — из тех же строк, в порядке записи (как в my_events_json)
+    mine = sorted((e for e in rows if e.my_registered_at), key=lambda e: e.my_registered_at)
+    unread = Notification.objects.filter(user=user, is_read=False).order_by("-created_at")[:100]
+
+    return {
+        "events": [_event_item(e, now) for e in rows],
+        "my_events": [_my_event_item(e) for e in mine],
+        "notifications": [_notification_item(n) for n in unread],
+    }
+
+
 @login_required(login_url="/login/")
 def dashboard(request):
     texts = generate_reminders_for_user(request.user)
@@ -126,38 +198,30 @@ def dashboard(request):
     for t in texts[:2]:
         messages.info(request, t)
 
-    return render(request, "events/dashboard.html")
+    return render(request, "events/dashboard.html", {
+        "ics_token": feed_token_for(request.user),
+        # данные встраиваются в страницу — без отдельных запросов при загрузке
+        "bootstrap": _dashboard_bootstrap(request.user),
+    })
 
 
 @login_required(login_url="/login/")
-def events_json(request):
-    now = timezone.localtime()
+@use_replica
+def dashboard_bootstrap_json(request):
+    # уведомления здесь не помечаются прочитанными — это делает notifications_json
+    return JsonResponse(_dashboard_bootstrap(request.user))
 
-    events = Event.objects.filter(is_cancelled=False).order_by("date", "time")
-    data = []
-
-    for e in events:
-        dt = _event_dt(e)
-        is_past = dt <= now
-        is_full = e.is_full()
-
-        start = f"{e.date}T{(e.time or '00:00')}"
-        data.append({
-            "id": e.id,
-            "title": e.title,
-            "start": start,
-            "description": e.description,
-            "place": e.place,
-            "capacity": e.capacity,
-            "taken": e.registered_count(),
-            "is_past": is_past,
-            "can_register": (not is_past) and (not is_full),
-        })
 
+@login_required(login_url="/login/")
+@use_replica
+def events_json(request):
+    now = timezone.localtime()
+    data = [_event_item(e, now) for e in _catalogue_rows()]
     return JsonResponse(data, safe=False)
 
 
 @login_required(login_url="/login/")
+@use_replica
 def my_events_json(request):
     regs = (
         Registration.objects
@@ -166,32 +230,51 @@ def my_events_json(request):
         .order_by("created_at")
     )
 
-    data = []
-    for r in regs:
-        e = r.event
-        data.append({
-            "id": e.id,
-            "title": e.title,
-            "date": str(e.date),
-            "time": str(e.time) if e.time else "",
-            "place": e.place,
-        })
-
+    data = [_my_event_item(r.event) for r in regs]
     return JsonResponse(data, safe=False)
 
 
+@use_replica
+def my_events_ics(request, token):
+    # подписка календаря: без сессии, доступ по подписанному токену
+    user_id = user_id_from_token(token)
+    if user_id is None:
+        raise Http404("Неверная ссылка на календарь")
+
+    etag = feed_state(user_id)
+
+    # клиент уже имеет актуальную версию — 304 без сборки ленты
+    not_modified = get_conditional_response(request, etag=quote_etag(etag))
+    if not_modified is not None:
+        return not_modified
+
+    response = HttpResponse(cached_feed(user_id, etag), content_type="text/calendar; charset=utf-8")
+    response["ETag"] = quote_etag(etag)
+    response["Content-Disposition"] = 'inline; filename="my-events.ics"'
+    patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+    return response
+
+
+@login_required(login_url="/login/")
+def rotate_ics_token(request):
+    if request.method != "POST":
+        return HttpResponseForbidden("Только POST")
+
+    feed, _ = CalendarFeed.objects.get_or_create(user=request.user)
+    feed.rotate()
+    messages.success(request, "Ссылка на календарь обновлена. Старая подписка больше не работает.")
+    return redirect("dashboard")
+
+
 @login_required(login_url="/login/")
+@use_replica
 def notifications_json(request):
     notes = Notification.objects.filter(user=request.user).order_by("-created_at")[:100]
-    data = [{
-        "id": n.id,
-        "title": n.title,
-        "body": n.body,
-        "created": n.created_at.strftime("%Y-%m-%d %H:%M"),
-        "is_read": n.is_read,
-    } for n in notes]
+    data = [_notification_item(n) for n in notes]
 
-    Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
+    # только показанные: список мог прийти с отстающей реплики
+    shown = [n.id for n in notes if not n.is_read]
+    Notification.objects.filter(pk__in=shown, is_read=False).update(is_read=True)
     return JsonResponse(data, safe=False)
 
 
@@ -215,17 +298,53 @@ def register_for_event(request, event_id):
         messages.error(request, "Ошибка: это мероприятие уже прошло. Записаться нельзя.")
         return redirect("dashboard")
 
-    # 3) нет мест
-    if event.is_full():
-        messages.error(request, "Свободных мест нет.")
+    # 3) сначала отдаём свободные места очереди — в т.ч. оставшиеся после сбоя продвижения
+    promote_from_waitlist(event.id)
+
+    if Registration.objects.filter(user=request.user, event=event).exists():
+        messages.info(request, "Вы уже зарегистрированы на это мероприятие.")
         return redirect("dashboard")
 
+    # решение «запись или очередь» и сама вставка — под одной блокировкой события,
+    # иначе отмена между ними продвинет очередь без этого пользователя
+    entry = position = None
     try:
-        reg = Registration.objects.create(user=request.user, event=event)
+        with transaction.atomic():
+            locked = Event.objects.select_for_update().get(pk=event.id)
+            if locked.is_cancelled:
+                messages.error(request, "Это мероприятие отменено. Записаться нельзя.")
+                return redirect("dashboard")
+
+            # непустая очередь = мест нет: записаться в обход ожидающих нельзя
+            waitlisted = locked.is_full() or locked.waitlist.exclude(user=request.user).exists()
+            if waitlisted:
+                # 4) нет мест — встаём в лист ожидания
+                try:
+                    with transaction.atomic():
+                        entry = WaitlistEntry.objects.create(user=request.user, event=locked)
+                except IntegrityError:
+                    pass
+                else:
+                    position = locked.waitlist.filter(created_at__lte=entry.created_at).count()
+            else:
+                reg = Registration.objects.create(user=request.user, event=locked)
+                WaitlistEntry.objects.filter(user=request.user, event=locked).delete()
     except IntegrityError:
         messages.info(request, "Вы уже зарегистрированы на это мероприятие.")
         return redirect("dashboard")
 
+    if waitlisted:
+        if entry is None:
+            messages.info(request, "Вы уже в листе ожидания на это мероприятие.")
+            return redirect("dashboard")
+
+        messages.info(
+            request,
+            f"Свободных мест нет. Вы в листе ожидания (позиция {position}) — "
+            f"при освобождении места запишем автоматически."
+        )
+        return redirect("dashboard")
+
     # ✅ РОВНО 1 уведомление (напоминание)
     title, body = _reminder_title_body(event, now=now)
     Notification.objects.create(user=request.user, title=title, body=body)
@@ -277,6 +396,7 @@ def leave_feedback(request, event_id):
 
 
 @login_required(login_url="/login/")
+@use_replica
 def reports(request):
     if not request.user.is_staff:
         return HttpResponseForbidden("Только администраторы/организаторы могут смотреть отчёты.")
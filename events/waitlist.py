@@ -0,0 +1,96 @@
+import logging
+import time
+
+from django.db import OperationalError, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Event, Registration, Notification, WaitlistEntry
+
+logger = logging.getLogger(__name__)
+
+PROMOTE_RETRIES = 3
+
+
+def _event_dt(event):
+    # views импортирует этот модуль — берём ту же функцию, что и register_for_event, лениво
+    from .views import _event_dt as event_dt
+    return event_dt(event)
+
+
+def promote_from_waitlist(event_id):
+    """
+    Переносит из листа ожидания столько человек, сколько свободно мест.
+    Одна транзакция, строка события под блокировкой (на SQLite — BEGIN IMMEDIATE),
+    поэтому параллельные отмены не выдадут одно место дважды. Работа O(k)
+    по числу свободных мест. Повторный вызов безопасен: лишние просто выходят.
+    """
+    with transaction.atomic():
+        event = Event.objects.select_for_update().filter(pk=event_id).first()
+        if event is None or event.is_cancelled or _event_dt(event) <= timezone.localtime():
+            return []
+
+        free = event.capacity - event.registrations.count()
+        if free <= 0:
+            return []
+
+        # уже записанные (напрямую или в обход очереди) не должны занимать место повторно
+        WaitlistEntry.objects.filter(
+            event=event,
+            user__in=Registration.objects.filter(event=event).values("user"),
+        ).delete()
+
+        entries = list(
+            WaitlistEntry.objects
+            .select_for_update()
+            .filter(event=event)
+            .order_by("created_at", "id")[:free]
+        )
+        if not entries:
+            return []
+
+        Registration.objects.bulk_create([Registration(user_id=w.user_id, event=event) for w in entries])
+        WaitlistEntry.objects.filter(pk__in=[w.pk for w in entries]).delete()
+
+        when_str = f"{event.date} {event.time or ''}".strip()
+        Notification.objects.bulk_create([
+            Notification(
+                user_id=w.user_id,
+                title="Место освободилось",
+                body=f"Вы записаны на «{event.title}» ({when_str}) из листа ожидания.",
+            )
+            for w in entries
+        ])
+
+    return [w.user_id for w in entries]
+
+
+def cancel_waitlist(event: Event, title: str, body: str):
+    """Событие отменено: уведомить всех из очереди одной вставкой и очистить её."""
+    entries = list(WaitlistEntry.objects.filter(event=event).values_list("pk", "user_id"))
+    Notification.objects.bulk_create([
+        Notification(user_id=user_id, title=title, body=body)
+        for _, user_id in entries
+    ])
+    WaitlistEntry.objects.filter(pk__in=[pk for pk, _ in entries]).delete()
+
+
+def _promote_after_delete(event_id):
+    # удаление уже закоммичено — ошибка здесь не должна превращаться в 500
+    for attempt in range(PROMOTE_RETRIES):
+        try:
+            return promote_from_waitlist(event_id)
+        except OperationalError:
+            time.sleep(0.1 * (attempt + 1))
+
+    # место не потеряется: очередь продвинется при следующей записи или сохранении в админке
+    logger.warning("Не удалось продвинуть лист ожидания события %s", event_id)
+    return []
+
+
+@receiver(post_delete, sender=Registration)
+def _registration_deleted(sender, instance, **kwargs):
+    # после коммита удаления; при массовом удалении лишние вызовы сразу выходят (free <= 0)
+    event_id = instance.event_id
+    transaction.on_commit(lambda: _promote_after_delete(event_id))
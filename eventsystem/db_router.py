@@ -0,0 +1,74 @@
+import random
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+
+PIN_COOKIE = "pin_primary"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# True только внутри view, помеченной @use_replica
+_read_from_replica = ContextVar("read_from_replica", default=False)
+
+
+def _replicas():
+    return getattr(settings, "DATABASE_REPLICAS", [])
+
+
+class PrimaryReplicaRouter:
+    """
+    Запись — всегда в default. Чтение уходит на реплику только внутри
+    view с @use_replica; всё остальное (сессии, auth, формы) читает primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = _replicas()
+        if replicas and _read_from_replica.get():
+            return random.choice(replicas)
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # primary и реплики — одна и та же база
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # схема меняется только на primary, реплики получают её через репликацию
+        return db == "default"
+
+
+def use_replica(view):
+    # read-after-write: после POST клиент несколько секунд закреплён за primary
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in SAFE_METHODS or request.COOKIES.get(PIN_COOKIE):
+            return view(request, *args, **kwargs)
+
+        token = _read_from_replica.set(True)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _read_from_replica.reset(token)
+
+    return wrapper
+
+
+class PrimaryPinMiddleware:
+    """После запроса с записью ставит короткую cookie, закрепляющую чтение за primary."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        if _replicas() and request.method not in SAFE_METHODS:
+            response.set_cookie(
+                PIN_COOKIE, "1",
+                max_age=getattr(settings, "REPLICA_PIN_SECONDS", 5),
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -26,6 +27,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "eventsystem.db_router.PrimaryPinMiddleware",
 ]
 
 ROOT_URLCONF = "eventsystem.urls"
@@ -52,9 +54,30 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # BEGIN IMMEDIATE: транзакция сразу берёт блокировку записи, а не падает
+        # с "database is locked" при апгрейде чтения до записи (продвижение очереди)
+        "OPTIONS": {"transaction_mode": "IMMEDIATE", "timeout": 20},
     }
 }
 
+# Реплики только для чтения (алиасы DATABASES, кроме default).
+# Локально вместо реплики — второй SQLite-файл: KINI_REPLICA_DB=db_replica.sqlite3
+# (migrate его не трогает — реплику получают копией db.sqlite3)
+if os.environ.get("KINI_REPLICA_DB"):
+    DATABASES["replica"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / os.environ["KINI_REPLICA_DB"],
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+DATABASE_ROUTERS = ["eventsystem.db_router.PrimaryReplicaRouter"]
+
+# сколько секунд после записи клиент читает только с primary
+REPLICA_PIN_SECONDS = 5
+
+DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
 STATIC_URL = "/static/"
 STATIC_ROOT = BASE_DIR / "staticfiles"
 